@@ -4,32 +4,117 @@ Created on Mar 12, 2015
 @author: derigible
 '''
 
-from django.conf.urls import url, patterns
 from django.conf import settings
 import importlib as il
-import os, sys, inspect, glob
+import importlib.util
+import functools
+import logging
+import os, re, sys, types
+from collections.abc import Iterable
 from django.views.generic.base import View
-import fnmatch
-import pkgutil
+
+logger = logging.getLogger(__name__)
+
+_PROJECT_URLS = __name__.partition('.')[0] + '.urls'
+
+_APP_DIR_CACHE = {} #app path -> (mtime, tuple of (module name, is package) pairs)
+
+def _scan_py_modules(root):
+    modules = []
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                if '.' not in entry.name and os.path.isfile(os.path.join(entry.path, '__init__.py')):
+                    modules.append((entry.name, True))
+            elif entry.name.endswith('.py') and entry.name != '__init__.py' and entry.is_file():
+                name = entry.name[:-3]
+                if '.' not in name:
+                    modules.append((name, False))
+    return tuple(sorted(modules))
+
+def _walk_py_modules(root):
+    '''
+    List the modules and packages directly inside of a package directory as (name, is package) pairs. The listing is
+    cached per path and is only refreshed when the mtime of the directory changes, so constructing several Routes objects
+    doesn't re-scan every app on disk.
+    '''
+    mtime = os.stat(root).st_mtime
+    cached = _APP_DIR_CACHE.get(root)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, _scan_py_modules(root))
+        _APP_DIR_CACHE[root] = cached
+    return cached[1]
+
+def _cached_import(name, package=None):
+    '''
+    Import a module, returning it straight from sys.modules when it has already been imported so the same dotted path is
+    only resolved by importlib once. Relative names are resolved against the package first so that ('.mod', 'pkg') and
+    'pkg.mod' hit the same sys.modules entry.
+    '''
+    if name.startswith('.'):
+        name = il.util.resolve_name(name, package)
+    return sys.modules.get(name) or il.import_module(name)
+
+@functools.lru_cache(maxsize=None)
+def _url_func():
+    '''
+    Get Django's regex url function. This is imported on first use so importing routes doesn't load Django's url machinery.
+    '''
+    try:
+        from django.urls import re_path
+    except ImportError: #Django < 2.0
+        from django.conf.urls import url as re_path
+    return re_path
+
+@functools.lru_cache(maxsize=None)
+def _as_view(cls):
+    '''
+    Get the view function for a class-based view, building it only once per class.
+    '''
+    return cls.as_view()
+
+def _iter_classes(mod):
+    '''
+    Yield the (name, class) pairs of the public classes found on a module.
+    '''
+    for name in dir(mod):
+        if name.startswith('_'):
+            continue
+        obj = getattr(mod, name, None)
+        if isinstance(obj, type):
+            yield name, obj
+
+def _iter_functions(mod):
+    '''
+    Yield the (name, function) pairs of the public functions found on a module.
+    '''
+    for name in dir(mod):
+        if name.startswith('_'):
+            continue
+        obj = getattr(mod, name, None)
+        if isinstance(obj, types.FunctionType):
+            yield name, obj
 
 def check_if_list(lst):
-    if isinstance(lst, str):
+    if isinstance(lst, (str, bytes)):
         '''
         Since strings are also iterable, this is used to make sure that the iterable is a non-string. Useful to ensure
         that only lists, tuples, etc. are used and that we don't have problems with strings creeping in.
         '''
         raise TypeError("Must be a non-string iterable: {}".format(lst))
-    if not (hasattr(lst, "__getitem__") or hasattr(lst, "__iter__")):
+    if not isinstance(lst, Iterable):
         raise TypeError("Must be an iterable: {}".format(lst))
     
 common_regex = {
-                'name' : "[\w|\d|\+|\.]*",
-                'url_encoded_name' : "[\w|\d|\+|\.|%|\s|\-|_|=|,|;|(|)|:]*",
-                'id' : "\d*",
-                'timestamp' : "\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}\+\d{2}:\d{2}",
-                'utc_ts' : "\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}\.\d{3}Z"
+                'name' : r"[\w|\d|\+|\.]*",
+                'url_encoded_name' : r"[\w|\d|\+|\.|%|\s|\-|_|=|,|;|(|)|:]*",
+                'id' : r"\d*",
+                'timestamp' : r"\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}\+\d{2}:\d{2}",
+                'utc_ts' : r"\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}\.\d{3}Z"
                 }
 
+common_regex_compiled = {k: re.compile(v) for k, v in common_regex.items()} #the same regexes, compiled once
+
 class Routes(object):
     '''
     A way of keeping track of routes at the view level instead of trying to define them all inside the urls.py. The hope
@@ -42,22 +127,48 @@ class Routes(object):
     routes = [] #Class instance so that lazy_routes will add to the routes table without having to add from the LazyRoutes list.
     acceptable_routes = ('app_module_view', 'module_view')
     tracked = set() #single definitive source of all routes
+    _registered = False #whether the ROUTE_AUTO_CREATE routes have been added yet, shared like routes
+    _frozen_urls = None #patterns built from routes, shared like routes and reset whenever a route is added
     
     def __init__(self):
         '''
         Initialiaze the routes object by creating a set that keeps track of all unformatted strings to ensure uniqueness.
         '''
         #Check if the urls.py has been loaded, and if not, then load it (for times when you want to create the urls without loading Django completely)
-        proj_name_urls = __name__.split('.')[0] + '.urls'
-        if proj_name_urls not in sys.modules:
-            il.import_module(proj_name_urls)
-        if hasattr(settings, "ROUTE_AUTO_CREATE"):
-            if settings.ROUTE_AUTO_CREATE == "app_module_view":
+        if _PROJECT_URLS not in sys.modules:
+            _cached_import(_PROJECT_URLS)
+    
+    def _ensure_registered(self):
+        '''
+        Register the routes for the installed apps if the ROUTE_AUTO_CREATE setting asks for it. This is deferred until the
+        routes are first needed so that creating a Routes object doesn't walk every installed app up front.
+        '''
+        if Routes._registered:
+            return
+        option = getattr(settings, "ROUTE_AUTO_CREATE", None)
+        if option is not None and option not in self.acceptable_routes:
+            raise ValueError("The route_auto_create option was set in settings but option {} is not a valid option. Valid options are: {}".format(option, self.acceptable_routes))
+        Routes._registered = True #set before walking since the views being loaded will call back into add
+        routes_count = len(self.routes)
+        tracked = set(self.tracked)
+        try:
+            if option == "app_module_view":
                 self._register_installed_apps_views(settings.INSTALLED_APPS, with_app = True)
-            elif settings.ROUTE_AUTO_CREATE == "module_view":
+            elif option == "module_view":
                 self._register_installed_apps_views(settings.INSTALLED_APPS)
-            else:
-                raise ValueError("The route_auto_create option was set in settings but option {} is not a valid option. Valid options are: {}".format(settings.route_auto_create, self.acceptable_routes))
+        except Exception:
+            #undo the partial walk so the next access can retry it from scratch
+            del self.routes[routes_count:]
+            self.tracked.intersection_update(tracked)
+            Routes._frozen_urls = None
+            Routes._registered = False
+            raise
+    
+    def _ensure_registered_for_add(self):
+        '''
+        Make sure the installed apps have been walked before adding routes to the table.
+        '''
+        self._ensure_registered()
     
     def _register_installed_apps_views(self, apps, with_app = False):
         '''
@@ -75,8 +186,6 @@ class Routes(object):
         called views.py if they are to be included. This does not make use of the Django app loader, so it is safe to put
         models in files outside of the models.py, as long as those views are class-based.
         
-        Note that class-based views must also not require any parameters in the initialization of the view.
-        
         To prevent select views from not being registered in this manner, set the register_route variable on the view to False.
         
         All functions within a views.py module are also added with this view. That means that any decorators will also have
@@ -85,62 +194,53 @@ class Routes(object):
         @param apps: the INSTALLED_APPS setting in the settings for your Django app.
         @param with_app: set to true if you want the app name to be included in the route
         '''
-        view_inst = View()
+        register_funcs = getattr(settings, 'REGISTER_VIEWS_PY_FUNCS', False) #read once rather than per module
+        
         def add_func(app, mod, funcName, func):
-            r = "{}/{}/((?:[^/]/*)*)".format(mod.lower(),funcName.lower())
-            if with_app:
-                r = "{}/{}".format(app.lower(), r)
-            self.add(r.replace('//', '/'), func, add_ending=False)
+            parts = [p for p in (app.lower() if with_app else None, mod.lower(), funcName.lower()) if p]
+            self.add('/'.join(parts) + "/((?:[^/]/*)*)", func, add_ending=False)
         
         def load_views(mod, mod_name, parent_mod_name = ""):
-            print("Information on the load_views:",mod, mod_name, parent_mod_name)
+            logger.debug("Loading views from %s as %s (parent: %s)", mod, mod_name, parent_mod_name)
             if parent_mod_name:
                 name_mod = parent_mod_name + '/' + mod_name
             else:
                 name_mod = mod_name
-            for klass in inspect.getmembers(mod, inspect.isclass):
-                print(klass)
-                try:
-                    inst = klass[1]()
-                    if isinstance(inst, View) and type(inst) != type(view_inst): #we do not want to add the View class
-                        if not hasattr(inst, 'register_route') or (hasattr(inst, 'register_route') and inst.register_route):
-                            add_func(app, name_mod, klass[0], klass[1].as_view())
-                        if hasattr(inst, 'routes'):
-                            self.add_view(klass[1])
-                except TypeError as e: #not a View class if init requires input.
-                    if "'function' object is not subscriptable" in str(e):
-                        raise ValueError("Attempting to do something wrong")
-                    pass
-            if mod_name == "views" and (hasattr(settings, 'REGISTER_VIEWS_PY_FUNCS') and settings.REGISTER_VIEWS_PY_FUNCS):
-                for func in inspect.getmembers(mod, inspect.isfunction):
+            for cls_name, klass in _iter_classes(mod):
+                if klass is View or not issubclass(klass, View): #we do not want to add the View class
+                    continue
+                if getattr(klass, 'register_route', True):
+                    add_func(app, name_mod, cls_name, _as_view(klass))
+                if hasattr(klass, 'routes'):
+                    self.add_view(klass)
+            if register_funcs and mod_name == "views":
+                for func in _iter_functions(mod):
                     add_func(app, name_mod, func[0], func[1])
         
         def load_module(mod, pkg, path = ""):
             '''
             Load the module and get all of the modules in it.
             '''
-            print("The module and pkg of the load_module:",mod, pkg, path)
-            loaded_app = il.import_module('.' + mod, pkg)
-            for finder, mname, ispkg in pkgutil.walk_packages([loaded_app.__path__[0]]):
-                print("Output of pkgutil: ",finder, mname, ispkg)
+            logger.debug("Loading module %s from package %s at %s", mod, pkg, path)
+            loaded_app = _cached_import('.' + mod, pkg)
+            mod_path = path + '/' + mod if path else mod
+            for mname, ispkg in _walk_py_modules(loaded_app.__path__[0]):
                 if ispkg:
-                    load_module(mname, loaded_app.__package__, path + '/' + mod)
-                views_mod = il.import_module('.' + mname, loaded_app.__package__)
-                load_views(views_mod, mname, path + '/' + mod) #Check if the module itself has any view classes
+                    load_module(mname, loaded_app.__package__, mod_path)
+                views_mod = _cached_import('.' + mname, loaded_app.__package__)
+                load_views(views_mod, mname, mod_path) #Check if the module itself has any view classes
             
-        for app in settings.INSTALLED_APPS:
-            app_name = app.split('.')[-1]
-            print()
-            print("the app: " + app_name)
-            if 'django' != app.split('.')[0]: #only do it for non-django apps
-                loaded_app = il.import_module(app)
-                print("Loaded app path: ", loaded_app.__path__[0])
-                for finder, mname, ispkg in pkgutil.walk_packages([loaded_app.__path__[0]]):
-                    if ispkg:
-                        load_module(mname, loaded_app.__package__)
-                    else:
-                        mod = il.import_module('.' + mname, loaded_app.__package__)
-                        load_views(mod, mname)
+        non_django_apps = [a for a in apps if not a.startswith('django.')] #only do it for non-django apps
+        for app in non_django_apps:
+            logger.debug("Registering views for app %s", app.rpartition('.')[2])
+            loaded_app = _cached_import(app)
+            logger.debug("Loaded app path: %s", loaded_app.__path__[0])
+            for mname, ispkg in _walk_py_modules(loaded_app.__path__[0]):
+                if ispkg:
+                    load_module(mname, loaded_app.__package__)
+                else:
+                    mod = _cached_import('.' + mname, loaded_app.__package__)
+                    load_views(mod, mname)
    
     def add(self, route, func, var_mappings= None, add_ending=True, **kwargs):
         '''
@@ -162,22 +262,43 @@ class Routes(object):
         @add_ending adds the appropriate /$ is on the ending if True. Defaults to True
         @kwargs the kwargs to be passed into the urls function
         '''
+        self._ensure_registered_for_add()
+        url_objs = self._build_urls(route, func, var_mappings, add_ending, **kwargs)
         self._check_if_format_exists(route)
+        self._commit_urls(url_objs)
+    
+    def _build_urls(self, route, func, var_mappings=None, add_ending=True, **kwargs):
+        '''
+        Build the url objects for the route without touching the routes table, so that nothing is tracked or added if
+        building any of them fails.
+        '''
+        url = _url_func()
+        suffix = '/$' if add_ending else ''
+        url_objs = []
         
-        def add_url(pattern, pmap, ending, opts):
-            url_route = '^{}{}'.format(pattern.format(*pmap), '/$' if ending else '')
-            if "django_url_name" in opts:
-                url_obj = url(url_route, func, kwargs, name=kwargs['django_url_name'])
+        def add_url(body):
+            url_route = '^' + body + suffix
+            if "django_url_name" in kwargs:
+                url_objs.append(url(url_route, func, kwargs, name=kwargs['django_url_name']))
             else:
-                url_obj = url(url_route, func, kwargs)
-            self.routes.append(url_obj)
+                url_objs.append(url(url_route, func, kwargs))
             
         if var_mappings:
             for mapr in var_mappings:
                 check_if_list(mapr)
-                add_url(route, mapr, add_ending, kwargs)
+                add_url(route.format(*mapr))
+        elif '{' in route or '}' in route: #still needs format to unescape any {{ or }}
+            add_url(route.format())
         else:
-            add_url(route, [], add_ending, kwargs)
+            add_url(route)
+        return url_objs
+    
+    def _commit_urls(self, url_objs):
+        '''
+        Add built url objects to the routes table.
+        '''
+        self.routes.extend(url_objs)
+        Routes._frozen_urls = None #the routes table changed, so the built urls are stale
     
     def add_list(self, routes, func, prefix=None, **kwargs):
         '''
@@ -199,22 +320,35 @@ class Routes(object):
         @prefix the prefix to attach to the route pattern
         '''
         check_if_list(routes)
+        self._ensure_registered_for_add()
+        routes = list(routes)
         for route in routes:
-            route_kwargs = kwargs.copy()
-            if 'kwargs' in route:
-                if type(route['kwargs']) != dict:
-                    raise TypeError("Must pass in a dictionary for kwargs.")
-                for k, v in route["kwargs"].items():
-                    route_kwargs[k] = v
-            self.add(route["pattern"] if prefix is None else '{}/{}'.format(prefix, route["pattern"]),
-                      func, var_mappings = route.get("map", []), **route_kwargs)
+            if 'kwargs' in route and not isinstance(route['kwargs'], dict):
+                raise TypeError("Must pass in a dictionary for kwargs.")
+        pending = [route["pattern"] if prefix is None else '{}/{}'.format(prefix, route["pattern"]) for route in routes]
+        self._check_if_formats_exist(pending)
+        url_objs = []
+        for route, pattern in zip(routes, pending):
+            extra = route.get('kwargs')
+            route_kwargs = kwargs if extra is None else {**kwargs, **extra}
+            url_objs.extend(self._build_urls(pattern, func, var_mappings = route.get("map", []), **route_kwargs))
+        self.tracked.update(pending) #only track the patterns once every url has been built
+        self._commit_urls(url_objs)
     
     @property
     def urls(self):
         '''
-        Get the urls from the Routes object. This a patterns object.
+        Get the urls from the Routes object. This a new list of the url patterns on every access.
         '''
-        return patterns(r'',*self.routes)
+        self._ensure_registered()
+        if Routes._frozen_urls is None:
+            try:
+                from django.conf.urls import patterns
+            except ImportError: #removed in Django 1.10, where the urls are a plain list
+                Routes._frozen_urls = tuple(self.routes)
+            else:
+                Routes._frozen_urls = tuple(patterns(r'',*self.routes))
+        return list(Routes._frozen_urls) #a fresh list, since urls.py commonly extends urlpatterns in place
         
     def _check_if_format_exists(self, route):
         '''
@@ -222,10 +356,23 @@ class Routes(object):
         
         @route the unformatted route being added.
         '''
-        if route in self.tracked:
+        before = len(self.tracked)
+        self.tracked.add(route)
+        if len(self.tracked) == before:
             raise ValueError("Cannot have duplicates of unformatted routes: {} already exists.".format(route))
-        else:
-            self.tracked.add(route)
+    
+    def _check_if_formats_exist(self, routes):
+        '''
+        Checks a batch of unformatted routes against the tracked routes and each other in one pass. The caller is
+        responsible for tracking them once they have been added.
+        
+        @routes the list of unformatted routes being added.
+        '''
+        dupes = self.tracked.intersection(routes)
+        if not dupes and len(set(routes)) != len(routes):
+            dupes = set(route for route in routes if routes.count(route) > 1)
+        if dupes:
+            raise ValueError("Cannot have duplicates of unformatted routes: {} already exists.".format(', '.join(sorted(dupes))))
             
     def add_view(self, view, **kwargs):
         '''
@@ -255,6 +402,7 @@ class Routes(object):
         
         @view the view to add
         '''
+        self._ensure_registered_for_add()
         if not hasattr(view, 'routes'):
             raise AttributeError("routes variable not defined on view {}".format(view.__name__))
         if hasattr(view, 'prefix'):
@@ -264,7 +412,7 @@ class Routes(object):
         if hasattr(view, 'add_ending') and 'add_ending' not in kwargs:
             kwargs['add_ending'] = view.add_ending
         
-        self.add_list(view.routes, view.as_view(), prefix = prefix, **kwargs)
+        self.add_list(view.routes, _as_view(view), prefix = prefix, **kwargs)
 
 class LazyRoutes(Routes):
     '''
@@ -278,6 +426,12 @@ class LazyRoutes(Routes):
         Do nothing, just overriding the base __init__ to prevent the initialization there.
         '''
         pass
+    
+    def _ensure_registered_for_add(self):
+        '''
+        Don't walk the installed apps when adding routes, since lazy routes are added while the apps are being walked.
+        '''
+        pass
         
 lazy_routes = LazyRoutes()
 routes = Routes()
\ No newline at end of file